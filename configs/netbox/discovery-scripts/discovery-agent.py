@@ -4,38 +4,128 @@ NetBox Network Discovery Agent
 Automatically discovers network devices and integrates with DNS and IPAM
 """
 
+import io
 import os
 import time
-import json
+import hashlib
+import sqlite3
+import functools
+import contextlib
+import orjson
+import queue
+import atexit
 import logging
+import logging.handlers
+import shutil
+import subprocess
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
 import schedule
+import ijson
 import requests
-import nmap
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import dns.resolver
 import dns.reversename
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from netaddr import IPNetwork, IPAddress
-from typing import Dict, List, Optional, Any
+from netaddr import IPNetwork, IPAddress, IPSet
+from typing import Dict, Iterator, List, Optional, Any
 
-# Configure logging
+# Configure logging; records go through a queue so worker threads never
+# block on file or console I/O
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/app/logs/discovery.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.FileHandler('/app/logs/discovery.log'),
+    logging.StreamHandler()
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# PTR query names are pure functions of the address; memoize the Name objects
+_reverse_name = functools.lru_cache(maxsize=8192)(dns.reversename.from_address)
+
+# Reverse DNS cache tuning (seconds)
+PTR_MIN_TTL = 300
+PTR_NEGATIVE_TTL = 60
+PTR_LOOKUP_TIMEOUT = 2.0
+
+# NetBox prefetch page size and how often an otherwise unchanged IP has
+# its last_seen custom field refreshed
+NETBOX_PAGE_SIZE = 1000
+NETBOX_BULK_SIZE = 100
+LAST_SEEN_REFRESH = timedelta(hours=24)
+
+# nmap invocations: one ping sweep across all networks, then targeted service scans
+PING_SWEEP_ARGS = ['-sn', '-PE', '-PP', '-PS22,53,80,443', '-T4', '--min-hostgroup=1024',
+                   '--min-rate=2000', '--max-retries=1', '--host-timeout=15s']
+SERVICE_SCAN_ARGS = ['-sV', '-p', '22,53,80,443,5380,8080,9000,3000,5432,6379,27017',
+                     '--max-retries=1', '--host-timeout=10s']
+SERVICE_SCAN_CONCURRENCY = 16
+
+# Discovery polling (minutes): back off after IDLE_CYCLES cycles with no new hosts
+DISCOVERY_INTERVAL = 30
+IDLE_DISCOVERY_INTERVAL = 120
+IDLE_CYCLES = 3
+
+class NetworkScanError(RuntimeError):
+    """The ping sweep failed, so the cycle's host counts are not meaningful"""
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Any, Future] = {}
+
+    def do(self, key: Any, fn, *args):
+        """Run fn(*args) unless a call for key is in flight, then share its result"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        
+        if not leader:
+            return future.result()
+        
+        try:
+            result = fn(*args)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
 class NetBoxDiscoveryAgent:
     def __init__(self):
         self.netbox_url = os.getenv('NETBOX_URL', 'http://netbox:8080')
         self.netbox_token = os.getenv('NETBOX_TOKEN')
         self.dns_server = os.getenv('DNS_SERVER', '10.203.1.3')
-        self.discovery_networks = os.getenv('DISCOVERY_NETWORKS', '10.203.0.0/16').split(',')
+        self.discovery_networks = [
+            IPNetwork(n.strip()) for n in os.getenv('DISCOVERY_NETWORKS', '10.203.0.0/16').split(',') if n.strip()
+        ]
         self.technitium_server = os.getenv('TECHNITIUM_SERVER', '10.203.1.3:5380')
         self.technitium_token = os.getenv('TECHNITIUM_API_TOKEN')
+        self.max_workers = int(os.getenv('DISCOVERY_WORKERS', '20'))
+        self.oui_database = os.getenv('OUI_DATABASE', '/usr/share/ieee-data/oui.txt')
+        self.state_db = os.getenv('DISCOVERY_STATE_DB', '/app/state/discovery.db')
+        
+        # Hosts/CIDRs that get a detailed service scan; empty means gateway-style
+        # addresses only (IPv4 .1 and .254)
+        self.service_scan_hosts = IPSet(
+            h.strip() for h in os.getenv('SERVICE_SCAN_HOSTS', '').split(',') if h.strip()
+        )
         
         # Initialize NetBox API headers
         self.headers = {
@@ -44,39 +134,182 @@ class NetBoxDiscoveryAgent:
             'Accept': 'application/json'
         }
         
-        # Initialize nmap scanner
-        self.nm = nmap.PortScanner()
+        # Pooled HTTP sessions (keep-alive across NetBox/Technitium calls)
+        self.session = self._build_session(self.headers, pool_maxsize=max(50, self.max_workers))
+        self.dns_session = self._build_session(
+            {'Authorization': f'Bearer {self.technitium_token}'},
+            pool_maxsize=max(10, self.max_workers)
+        )
+        
+        # Reverse DNS resolver pinned to our DNS server, with a TTL cache of
+        # ip -> (expires_at, hostname); misses are cached as None
+        self.resolver = dns.resolver.Resolver(configure=False)
+        self.resolver.nameservers = [self.dns_server]
+        self.resolver.timeout = PTR_LOOKUP_TIMEOUT
+        self.resolver.lifetime = PTR_LOOKUP_TIMEOUT
+        self._ptr_cache: Dict[str, tuple] = {}
+        self._ptr_flight = SingleFlight()
+        
+        # NetBox object caches; the IP index is rebuilt every cycle
+        self._site_cache: Dict[str, Dict] = {}
+        self._prefix_cache: Dict[str, Dict] = {}
+        self._ip_index: Dict[str, Dict] = {}
         
-        logger.info(f"Initialized NetBox Discovery Agent")
-        logger.info(f"NetBox URL: {self.netbox_url}")
-        logger.info(f"Discovery Networks: {self.discovery_networks}")
+        # ETag and body per (url, params) for conditional prefetch GETs
+        self._etag_cache: Dict[tuple, tuple] = {}
+        
+        # IP writes queued by update_netbox_ip, flushed in bulk per cycle
+        self._pending_create: List[Dict] = []
+        self._pending_update: List[Dict] = []
+        
+        # Local MAC vendor database (OUI prefix -> organization)
+        self._oui: Dict[str, str] = {}
+        self.reload_oui()
+        
+        # Host state persisted across cycles and restarts, so unchanged hosts
+        # skip NetBox/DNS work; rows are loaded and saved once per cycle
+        self._state = self._open_state_db()
+        self._known_hosts: Dict[str, tuple] = {}
+        self._state_updates: List[tuple] = []
+        
+        # Adaptive scheduling state; last_report feeds the hourly export
+        self.last_report: Optional[Dict] = None
+        self._discovery_interval: Optional[int] = None
+        self._consecutive_no_change = 0
+        
+        # Bound concurrent nmap service scans across the host worker pool
+        self._service_scan_slots = threading.BoundedSemaphore(SERVICE_SCAN_CONCURRENCY)
+        if not shutil.which('nmap'):
+            logger.warning("⚠️ nmap not found in PATH, network scans will fail")
+        
+        logger.info("Initialized NetBox Discovery Agent")
+        logger.info("NetBox URL: %s", self.netbox_url)
+        logger.info("Discovery Networks: %s", [str(n) for n in self.discovery_networks])
+
+    @staticmethod
+    def _build_session(headers: Dict, pool_maxsize: int, retries: int = 2) -> requests.Session:
+        """Create a requests session with a pooled, retrying adapter"""
+        session = requests.Session()
+        session.headers.update(headers)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(total=retries, backoff_factor=0.2)
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        """Close pooled HTTP sessions and the state database"""
+        for session in (self.session, self.dns_session):
+            session.close()
+        self._state.close()
+
+    def _open_state_db(self) -> sqlite3.Connection:
+        """Open the local host state database, creating it if needed"""
+        try:
+            state_dir = os.path.dirname(self.state_db)
+            if state_dir:
+                os.makedirs(state_dir, exist_ok=True)
+            conn = sqlite3.connect(self.state_db)
+            self._create_state_schema(conn)
+        except (OSError, sqlite3.Error) as e:
+            # Run without persistence rather than refusing to start
+            logger.warning("⚠️ Failed to open discovery state %s, using in-memory state: %s", self.state_db, e)
+            conn = sqlite3.connect(':memory:')
+            self._create_state_schema(conn)
+        return conn
+
+    @staticmethod
+    def _create_state_schema(conn: sqlite3.Connection):
+        """Create the hosts table if it does not exist yet"""
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS hosts ("
+            "ip TEXT PRIMARY KEY, mac TEXT, hostname TEXT, vendor TEXT, "
+            "hash TEXT, last_seen TIMESTAMP, last_synced TIMESTAMP)"
+        )
+        conn.commit()
+
+    def _load_state(self):
+        """Load known host hashes and last sync times from the state database"""
+        try:
+            rows = self._state.execute("SELECT ip, hash, last_synced FROM hosts")
+            self._known_hosts = {ip: (digest, last_synced) for ip, digest, last_synced in rows}
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Failed to load discovery state: %s", e)
+            self._known_hosts = {}
+        self._state_updates = []
+
+    def _save_state(self, failed_ips: set):
+        """Persist this cycle's host state in one batch, skipping failed NetBox writes"""
+        rows = [row for row in self._state_updates if row[0] not in failed_ips]
+        try:
+            with self._state:
+                self._state.executemany(
+                    "INSERT INTO hosts (ip, mac, hostname, vendor, hash, last_seen, last_synced) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(ip) DO UPDATE SET mac = excluded.mac, hostname = excluded.hostname, "
+                    "vendor = excluded.vendor, hash = excluded.hash, last_seen = excluded.last_seen, "
+                    "last_synced = excluded.last_synced",
+                    rows
+                )
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Failed to save discovery state: %s", e)
+        self._state_updates = []
+
+    @staticmethod
+    def _host_hash(host: Dict) -> str:
+        """Fingerprint the discovered attributes that drive NetBox/DNS updates"""
+        return hashlib.blake2s(f"{host['ip']}|{host['mac_address']}|{host['hostname']}".encode()).hexdigest()
+
+    def _is_unchanged(self, host: Dict, digest: str) -> bool:
+        """Check whether a host matches its stored state and was synced recently"""
+        known = self._known_hosts.get(host['ip'])
+        if not known or known[0] != digest or host['ip'] not in self._ip_index:
+            return False
+        try:
+            # Re-sync at least as often as NetBox last_seen needs refreshing
+            return datetime.now() - datetime.fromisoformat(known[1]) < LAST_SEEN_REFRESH
+        except (TypeError, ValueError):
+            return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def test_netbox_connection(self) -> bool:
         """Test connection to NetBox API"""
         try:
-            response = requests.get(f"{self.netbox_url}/api/", headers=self.headers, timeout=10)
+            response = self.session.get(f"{self.netbox_url}/api/", timeout=10)
             if response.status_code == 200:
                 logger.info("✅ NetBox API connection successful")
                 return True
             else:
-                logger.error(f"❌ NetBox API returned status {response.status_code}")
+                logger.error("❌ NetBox API returned status %s", response.status_code)
                 return False
         except Exception as e:
-            logger.error(f"❌ Failed to connect to NetBox API: {e}")
+            logger.error("❌ Failed to connect to NetBox API: %s", e)
             return False
 
     def get_or_create_site(self, name: str = "Homelab") -> Dict:
         """Get or create a site in NetBox"""
+        if name in self._site_cache:
+            return self._site_cache[name]
+        
         try:
             # Check if site exists
-            response = requests.get(
+            response = self.session.get(
                 f"{self.netbox_url}/api/dcim/sites/",
-                headers=self.headers,
-                params={'name': name}
+                params={'name': name, 'limit': 1, 'brief': 1}
             )
             
-            if response.status_code == 200 and response.json()['count'] > 0:
-                return response.json()['results'][0]
+            results = response.json()['results'] if response.status_code == 200 else []
+            if results:
+                self._site_cache[name] = results[0]
+                return self._site_cache[name]
             
             # Create new site
             site_data = {
@@ -86,35 +319,39 @@ class NetBoxDiscoveryAgent:
                 'status': 'active'
             }
             
-            response = requests.post(
+            response = self.session.post(
                 f"{self.netbox_url}/api/dcim/sites/",
-                headers=self.headers,
-                data=json.dumps(site_data)
+                data=orjson.dumps(site_data)
             )
             
             if response.status_code == 201:
-                logger.info(f"✅ Created site: {name}")
-                return response.json()
+                logger.info("✅ Created site: %s", name)
+                self._site_cache[name] = response.json()
+                return self._site_cache[name]
             else:
-                logger.error(f"❌ Failed to create site: {response.text}")
+                logger.error("❌ Failed to create site: %s", response.text)
                 return None
                 
         except Exception as e:
-            logger.error(f"❌ Error handling site: {e}")
+            logger.error("❌ Error handling site: %s", e)
             return None
 
     def get_or_create_prefix(self, prefix: str, site_id: int) -> Dict:
         """Get or create a prefix in NetBox"""
+        if prefix in self._prefix_cache:
+            return self._prefix_cache[prefix]
+        
         try:
             # Check if prefix exists
-            response = requests.get(
+            response = self.session.get(
                 f"{self.netbox_url}/api/ipam/prefixes/",
-                headers=self.headers,
-                params={'prefix': prefix}
+                params={'prefix': prefix, 'limit': 1, 'brief': 1}
             )
             
-            if response.status_code == 200 and response.json()['count'] > 0:
-                return response.json()['results'][0]
+            results = response.json()['results'] if response.status_code == 200 else []
+            if results:
+                self._prefix_cache[prefix] = results[0]
+                return self._prefix_cache[prefix]
             
             # Create new prefix
             prefix_data = {
@@ -125,118 +362,267 @@ class NetBoxDiscoveryAgent:
                 'is_pool': True
             }
             
-            response = requests.post(
+            response = self.session.post(
                 f"{self.netbox_url}/api/ipam/prefixes/",
-                headers=self.headers,
-                data=json.dumps(prefix_data)
+                data=orjson.dumps(prefix_data)
             )
             
             if response.status_code == 201:
-                logger.info(f"✅ Created prefix: {prefix}")
-                return response.json()
+                logger.info("✅ Created prefix: %s", prefix)
+                self._prefix_cache[prefix] = response.json()
+                return self._prefix_cache[prefix]
             else:
-                logger.error(f"❌ Failed to create prefix: {response.text}")
+                logger.error("❌ Failed to create prefix: %s", response.text)
                 return None
                 
         except Exception as e:
-            logger.error(f"❌ Error handling prefix: {e}")
+            logger.error("❌ Error handling prefix: %s", e)
             return None
 
-    def perform_network_scan(self, network: str) -> List[Dict]:
-        """Perform network scan and return discovered hosts"""
-        logger.info(f"🔍 Scanning network: {network}")
-        discovered_hosts = []
+    @contextlib.contextmanager
+    def _conditional_get(self, url: str, params: Dict):
+        """GET a NetBox URL, revalidating with If-None-Match, and yield a readable body"""
+        key = (url, tuple(sorted(params.items())))
+        cached = self._etag_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached else {}
         
-        try:
-            # Perform ping scan with service detection
-            scan_result = self.nm.scan(
-                hosts=network,
-                arguments='-sn -PE -PP -PS80,443,22,53 --max-retries=2 --host-timeout=30s'
-            )
+        with self.session.get(url, params=params, headers=headers, timeout=30, stream=True) as response:
+            if response.status_code == 304 and cached:
+                yield io.BytesIO(cached[1])
+                return
+            response.raise_for_status()
             
-            for host in self.nm.all_hosts():
-                if self.nm[host].state() == 'up':
-                    host_info = {
-                        'ip': host,
-                        'hostname': None,
-                        'mac_address': None,
-                        'vendor': None,
-                        'last_seen': datetime.now().isoformat(),
-                        'services': []
-                    }
-                    
-                    # Get hostname via reverse DNS
-                    try:
-                        hostname = dns.resolver.resolve(dns.reversename.from_address(host), 'PTR')[0].to_text().rstrip('.')
-                        host_info['hostname'] = hostname
-                    except:
-                        pass
-                    
-                    # Get MAC address if available
-                    if 'mac' in self.nm[host]['addresses']:
-                        host_info['mac_address'] = self.nm[host]['addresses']['mac']
-                        
-                        # Try to get vendor from MAC
-                        try:
-                            vendor_response = requests.get(f"https://api.macvendors.com/{host_info['mac_address']}", timeout=5)
-                            if vendor_response.status_code == 200:
-                                host_info['vendor'] = vendor_response.text
-                        except:
-                            pass
+            etag = response.headers.get('ETag')
+            if etag:
+                # Keep the body so an unchanged page later costs only a 304
+                self._etag_cache[key] = (etag, response.content)
+                yield io.BytesIO(response.content)
+            else:
+                self._etag_cache.pop(key, None)
+                response.raw.decode_content = True
+                yield response.raw
+
+    def _iter_netbox_results(self, path: str, params: Dict):
+        """Yield every result from a paginated NetBox list endpoint, one record at a time"""
+        url = f"{self.netbox_url}{path}"
+        offset = 0
+        while True:
+            page_params = {**params, 'limit': NETBOX_PAGE_SIZE, 'offset': offset}
+            with self._conditional_get(url, page_params) as body:
+                # Stream-parse results so a full page is never materialized
+                received = 0
+                for item in ijson.items(body, 'results.item', use_float=True):
+                    received += 1
+                    yield item
+            
+            # NetBox may cap limit below our page size, so stop on an empty page
+            if not received:
+                return
+            offset += received
+
+    def _load_netbox_index(self) -> bool:
+        """Prefetch existing NetBox IPs in the discovery networks, keyed by address"""
+        try:
+            index = {}
+            for network in self.discovery_networks:
+                for ip in self._iter_netbox_results('/api/ipam/ip-addresses/', {'parent': str(network)}):
+                    index[ip['address'].split('/')[0]] = ip
+            self._ip_index = index
+            logger.info("📚 Loaded %s existing IPs from NetBox", len(index))
+            return True
+        except Exception as e:
+            logger.error("❌ Failed to load NetBox IP index: %s", e)
+            return False
+
+    def _ip_needs_update(self, existing: Dict, netbox_data: Dict) -> bool:
+        """Check whether an indexed NetBox IP differs from freshly discovered data"""
+        status = existing.get('status') or {}
+        if isinstance(status, dict):
+            status = status.get('value')
+        if status != netbox_data['status'] or existing.get('description') != netbox_data['description']:
+            return True
+        if 'dns_name' in netbox_data and existing.get('dns_name') != netbox_data['dns_name']:
+            return True
+        
+        custom_fields = existing.get('custom_fields') or {}
+        if custom_fields.get('discovery_method') != netbox_data['custom_fields']['discovery_method']:
+            return True
+        try:
+            last_seen = datetime.fromisoformat(custom_fields['last_seen'])
+            seen_now = datetime.fromisoformat(netbox_data['custom_fields']['last_seen'])
+            return seen_now - last_seen > LAST_SEEN_REFRESH
+        except (KeyError, TypeError, ValueError):
+            return True
+
+    def reload_oui(self):
+        """Load the IEEE OUI registry (oui.txt or Wireshark manuf format)"""
+        oui = {}
+        try:
+            with open(self.oui_database, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if '(base 16)' in line:
+                        # oui.txt: "00000C     (base 16)\t\tCisco Systems, Inc"
+                        prefix, _, vendor = line.partition('(base 16)')
+                    elif line.strip() and not line.startswith('#') and '\t' in line:
+                        # manuf: "00:00:0C\tCisco\tCisco Systems, Inc"
+                        fields = line.rstrip('\n').split('\t')
+                        prefix, vendor = fields[0].replace(':', '').replace('-', ''), fields[-1]
+                    else:
+                        continue
+                    prefix = prefix.strip().upper()
+                    if len(prefix) == 6:
+                        oui[prefix] = vendor.strip()
+        except OSError as e:
+            logger.warning("⚠️ OUI database unavailable (%s), MAC vendors limited to nmap's", e)
+            return
+        
+        self._oui = oui
+        logger.info("📚 Loaded %s OUI vendor prefixes", len(oui))
+
+    def _lookup_vendor(self, mac: str) -> Optional[str]:
+        """Look up a MAC address vendor in the local OUI database"""
+        return self._oui.get(mac.replace(':', '').replace('-', '').upper()[:6])
+
+    def _reverse_lookup(self, ip: str) -> Optional[str]:
+        """Resolve the PTR name for an IP, caching hits and misses"""
+        now = time.monotonic()
+        cached = self._ptr_cache.get(ip)
+        if cached and cached[0] > now:
+            return cached[1]
+        
+        # Concurrent workers asking for the same IP share one query
+        return self._ptr_flight.do(ip, self._resolve_ptr, ip)
+
+    def _resolve_ptr(self, ip: str) -> Optional[str]:
+        """Query the PTR record for an IP and store the result in the cache"""
+        try:
+            answer = self.resolver.resolve(_reverse_name(ip), 'PTR')
+            hostname = answer[0].to_text().rstrip('.')
+            ttl = max(answer.rrset.ttl, PTR_MIN_TTL)
+        except Exception:
+            hostname = None
+            ttl = PTR_NEGATIVE_TTL
+        
+        self._ptr_cache[ip] = (time.monotonic() + ttl, hostname)
+        return hostname
+
+    @staticmethod
+    def _run_nmap(targets: List[str], arguments: List[str]):
+        """Run nmap with XML on stdout and yield each <host> element as it completes"""
+        # stderr goes to a temp file, not a pipe: a long sweep can emit enough
+        # per-packet warnings to fill a pipe and block nmap while we wait on stdout
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen(
+            ['nmap', *arguments, '-oX', '-', *targets],
+            stdout=subprocess.PIPE,
+            stderr=stderr
+        )
+        parse_error = None
+        try:
+            try:
+                for _, elem in ET.iterparse(proc.stdout):
+                    if elem.tag == 'host':
+                        yield elem
+                        elem.clear()
+            except ET.ParseError as e:
+                # Usually nmap aborting early; prefer its exit status below
+                parse_error = e
+            proc.wait()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+        
+        with stderr:
+            if proc.returncode != 0:
+                # Only the last few lines are useful and the file may be large
+                stderr.seek(max(0, stderr.seek(0, io.SEEK_END) - 4096))
+                tail = stderr.read().decode(errors='replace').strip().splitlines()[-10:]
+                raise RuntimeError(f"nmap exited with status {proc.returncode}: {' '.join(tail)}")
+        if parse_error:
+            raise parse_error
+
+    def perform_network_scan(self, networks: List[IPNetwork]) -> Iterator[Dict]:
+        """Sweep all networks in one nmap run, yielding hosts as nmap reports them"""
+        targets = [str(network) for network in networks]
+        logger.info("🔍 Scanning networks: %s", ', '.join(targets))
+        per_network = {target: 0 for target in targets}
+        
+        try:
+            # A single invocation pays nmap's startup cost once and lets its
+            # scheduler spread probes across every network
+            for host in self._run_nmap(targets, PING_SWEEP_ARGS):
+                status = host.find('status')
+                if status is None or status.get('state') != 'up':
+                    continue
+                
+                addresses = {addr.get('addrtype'): addr for addr in host.iter('address')}
+                ip = addresses.get('ipv4', addresses.get('ipv6'))
+                host_info = {
+                    'ip': ip.get('addr'),
+                    'hostname': None,
+                    'mac_address': None,
+                    'vendor': None,
+                    'last_seen': datetime.now().isoformat(),
+                    'services': []
+                }
+                
+                # Get MAC address if available
+                if 'mac' in addresses:
+                    mac = addresses['mac']
+                    host_info['mac_address'] = mac.get('addr')
                     
-                    discovered_hosts.append(host_info)
-                    logger.info(f"📍 Found host: {host} ({host_info.get('hostname', 'Unknown')})")
+                    # Vendor from nmap's own prefix table, else the OUI database
+                    host_info['vendor'] = mac.get('vendor') or self._lookup_vendor(host_info['mac_address'])
+                
+                address = IPAddress(host_info['ip'])
+                for network, target in zip(networks, targets):
+                    if address in network:
+                        per_network[target] += 1
+                        break
+                yield host_info
             
-            logger.info(f"✅ Network scan complete: {len(discovered_hosts)} hosts discovered")
-            return discovered_hosts
+            for network, discovered in per_network.items():
+                logger.info("✅ Network scan complete for %s: %s hosts discovered", network, discovered)
             
         except Exception as e:
-            logger.error(f"❌ Network scan failed: {e}")
-            return []
+            logger.error("❌ Network scan failed: %s", e)
+            raise NetworkScanError(str(e)) from e
 
     def perform_service_scan(self, ip: str) -> List[Dict]:
         """Perform detailed service scan on a host"""
         services = []
         try:
             # Scan common ports
-            scan_result = self.nm.scan(
-                hosts=ip,
-                ports='22,53,80,443,5380,8080,9000,3000,5432,6379,27017',
-                arguments='-sV --max-retries=1 --host-timeout=10s'
-            )
-            
-            if ip in self.nm.all_hosts():
-                for protocol in self.nm[ip].all_protocols():
-                    ports = self.nm[ip][protocol].keys()
-                    for port in ports:
-                        port_info = self.nm[ip][protocol][port]
-                        if port_info['state'] == 'open':
-                            service = {
-                                'port': port,
-                                'protocol': protocol,
-                                'service': port_info.get('name', 'unknown'),
-                                'version': port_info.get('version', ''),
-                                'product': port_info.get('product', '')
-                            }
-                            services.append(service)
+            with self._service_scan_slots:
+                for host in self._run_nmap([ip], SERVICE_SCAN_ARGS):
+                    for port in host.iter('port'):
+                        state = port.find('state')
+                        if state is None or state.get('state') != 'open':
+                            continue
+                        
+                        service_info = port.find('service')
+                        service_attrs = service_info.attrib if service_info is not None else {}
+                        service = {
+                            'port': int(port.get('portid')),
+                            'protocol': port.get('protocol'),
+                            'service': service_attrs.get('name', 'unknown'),
+                            'version': service_attrs.get('version', ''),
+                            'product': service_attrs.get('product', '')
+                        }
+                        services.append(service)
             
         except Exception as e:
-            logger.debug(f"Service scan failed for {ip}: {e}")
+            logger.debug("Service scan failed for %s: %s", ip, e)
         
         return services
 
     def update_netbox_ip(self, ip_data: Dict) -> bool:
-        """Update or create IP address in NetBox"""
+        """Queue an IP address create or update for the next bulk flush"""
         try:
             ip_address = ip_data['ip']
             
-            # Check if IP exists
-            response = requests.get(
-                f"{self.netbox_url}/api/ipam/ip-addresses/",
-                headers=self.headers,
-                params={'address': ip_address}
-            )
-            
             netbox_data = {
                 'address': ip_address,
                 'status': 'active',
@@ -250,35 +636,66 @@ class NetBoxDiscoveryAgent:
             if ip_data.get('hostname'):
                 netbox_data['dns_name'] = ip_data['hostname']
             
-            if response.status_code == 200 and response.json()['count'] > 0:
-                # Update existing IP
-                ip_id = response.json()['results'][0]['id']
-                response = requests.patch(
-                    f"{self.netbox_url}/api/ipam/ip-addresses/{ip_id}/",
-                    headers=self.headers,
-                    data=json.dumps(netbox_data)
-                )
-                action = "Updated"
-            else:
-                # Create new IP
-                response = requests.post(
-                    f"{self.netbox_url}/api/ipam/ip-addresses/",
-                    headers=self.headers,
-                    data=json.dumps(netbox_data)
-                )
-                action = "Created"
+            # Check the prefetched index instead of querying per host
+            existing = self._ip_index.get(ip_address)
             
-            if response.status_code in [200, 201]:
-                logger.debug(f"✅ {action} IP in NetBox: {ip_address}")
+            if existing and not self._ip_needs_update(existing, netbox_data):
+                logger.debug("IP unchanged in NetBox: %s", ip_address)
                 return True
+            
+            if existing:
+                # Update existing IP
+                netbox_data['id'] = existing['id']
+                self._pending_update.append(netbox_data)
             else:
-                logger.error(f"❌ Failed to update NetBox IP {ip_address}: {response.text}")
-                return False
+                # Create new IP
+                self._pending_create.append(netbox_data)
+            return True
                 
         except Exception as e:
-            logger.error(f"❌ Error updating NetBox IP: {e}")
+            logger.error("❌ Error updating NetBox IP: %s", e)
             return False
 
+    def _write_ip_batch(self, method: str, batch: List[Dict]) -> List[str]:
+        """Send one bulk IP write, retrying items individually on failure; returns failed IPs"""
+        url = f"{self.netbox_url}/api/ipam/ip-addresses/"
+        send = getattr(self.session, method)
+        
+        try:
+            response = send(url, data=orjson.dumps(batch))
+            if response.status_code in [200, 201]:
+                for ip in response.json():
+                    self._ip_index[ip['address'].split('/')[0]] = ip
+                logger.debug("✅ Bulk %s of %s IPs in NetBox", method.upper(), len(batch))
+                return []
+            logger.warning("⚠️ Bulk %s of %s IPs failed: %s", method.upper(), len(batch), response.text)
+        except Exception as e:
+            logger.warning("⚠️ Bulk %s of %s IPs failed: %s", method.upper(), len(batch), e)
+        
+        # Re-issue individually so one bad record doesn't drop the whole batch
+        failed = []
+        for item in batch:
+            item_url = f"{url}{item['id']}/" if method == 'patch' else url
+            try:
+                response = send(item_url, data=orjson.dumps(item))
+                if response.status_code in [200, 201]:
+                    self._ip_index[item['address']] = response.json()
+                    continue
+                logger.error("❌ Failed to update NetBox IP %s: %s", item['address'], response.text)
+            except Exception as e:
+                logger.error("❌ Error updating NetBox IP %s: %s", item['address'], e)
+            failed.append(item['address'])
+        return failed
+
+    def _flush_netbox_ips(self) -> set:
+        """Write all queued IP creates/updates in bulk; returns IPs whose write failed"""
+        failed = set()
+        for method, pending in (('post', self._pending_create), ('patch', self._pending_update)):
+            for start in range(0, len(pending), NETBOX_BULK_SIZE):
+                failed.update(self._write_ip_batch(method, pending[start:start + NETBOX_BULK_SIZE]))
+            pending.clear()
+        return failed
+
     def sync_to_dns(self, ip_data: Dict) -> bool:
         """Sync discovered host to DNS server"""
         if not self.technitium_token or not ip_data.get('hostname'):
@@ -294,39 +711,109 @@ class NetBoxDiscoveryAgent:
                 'ttl': 300
             }
             
-            response = requests.post(
+            response = self.dns_session.post(
                 f"http://{self.technitium_server}/api/zones/records/add",
-                headers={'Authorization': f'Bearer {self.technitium_token}'},
                 data=dns_data
             )
             
             if response.status_code == 200:
-                logger.info(f"✅ Synced to DNS: {dns_data['domain']} -> {ip_data['ip']}")
+                logger.info("✅ Synced to DNS: %s -> %s", dns_data['domain'], ip_data['ip'])
                 return True
             else:
-                logger.debug(f"DNS sync failed for {ip_data['hostname']}: {response.text}")
+                logger.debug("DNS sync failed for %s: %s", ip_data['hostname'], response.text)
                 return False
                 
         except Exception as e:
-            logger.error(f"❌ DNS sync error: {e}")
+            logger.error("❌ DNS sync error: %s", e)
             return False
 
+    def _wants_service_scan(self, ip: str) -> bool:
+        """Check whether a host should get a detailed service scan"""
+        address = IPAddress(ip)
+        if self.service_scan_hosts:
+            return address in self.service_scan_hosts
+        return address.version == 4 and address.words[-1] in (1, 254)
+
+    def _process_host(self, host: Dict) -> Dict:
+        """Resolve, scan, record and DNS-sync a single host; runs inside the worker pool"""
+        result = {'services': 0, 'new': host['ip'] not in self._ip_index, 'updated': False,
+                  'dns_synced': False, 'skipped': False}
+        
+        # Get hostname via reverse DNS
+        host['hostname'] = self._reverse_lookup(host['ip'])
+        logger.info("📍 Found host: %s (%s)", host['ip'], host['hostname'] or 'Unknown')
+        
+        # Short-circuit hosts unchanged since their last sync; only last_seen moves
+        digest = self._host_hash(host)
+        state = (host['ip'], host['mac_address'], host['hostname'], host['vendor'], digest, host['last_seen'])
+        if self._is_unchanged(host, digest):
+            self._state_updates.append((*state, self._known_hosts[host['ip']][1]))
+            result['skipped'] = True
+            return result
+        
+        # Perform detailed service scan for interesting hosts
+        if self._wants_service_scan(host['ip']):
+            host['services'] = self.perform_service_scan(host['ip'])
+            result['services'] = len(host['services'])
+        
+        # Update NetBox
+        result['updated'] = self.update_netbox_ip(host)
+        
+        # Sync to DNS if hostname available
+        result['dns_synced'] = self.sync_to_dns(host)
+        
+        # Record as synced unless a needed DNS sync failed, so it is retried
+        # next cycle; failed NetBox writes are dropped when state is saved
+        last_synced = host['last_seen']
+        if self.technitium_token and host['hostname'] and not result['dns_synced']:
+            last_synced = None
+        self._state_updates.append((*state, last_synced))
+        
+        return result
+
     def generate_network_report(self) -> Dict:
         """Generate comprehensive network report"""
         report = {
             'timestamp': datetime.now().isoformat(),
-            'networks_scanned': self.discovery_networks,
+            'networks_scanned': [str(n) for n in self.discovery_networks],
             'total_hosts': 0,
             'active_hosts': 0,
             'new_hosts': 0,
             'updated_hosts': 0,
             'dns_synced': 0,
-            'services_discovered': 0
+            'services_discovered': 0,
+            'skipped_hosts': 0
         }
         
         return report
 
+    def schedule_discovery(self, minutes: int):
+        """(Re)schedule the periodic discovery job at the given interval"""
+        schedule.clear('discovery')
+        schedule.every(minutes).minutes.do(self.run_discovery).tag('discovery')
+        self._discovery_interval = minutes
+
+    def _adjust_schedule(self, report: Dict):
+        """Slow polling down on idle networks and speed back up on churn"""
+        if report['new_hosts']:
+            self._consecutive_no_change = 0
+        else:
+            self._consecutive_no_change += 1
+        
+        interval = IDLE_DISCOVERY_INTERVAL if self._consecutive_no_change >= IDLE_CYCLES else DISCOVERY_INTERVAL
+        if interval != self._discovery_interval:
+            logger.info("⏰ Discovery interval now every %s minutes", interval)
+            self.schedule_discovery(interval)
+
     def run_discovery(self) -> Dict:
+        """Run one discovery cycle and adapt the polling interval to churn"""
+        report = self._discover()
+        self.last_report = report
+        if report['status'] == 'completed':
+            self._adjust_schedule(report)
+        return report
+
+    def _discover(self) -> Dict:
         """Main discovery process"""
         logger.info("🚀 Starting network discovery process")
         start_time = datetime.now()
@@ -342,44 +829,61 @@ class NetBoxDiscoveryAgent:
             logger.error("❌ Failed to create/get site")
             return {'status': 'failed', 'reason': 'site_creation_failed'}
         
+        # Prefetch existing IPs once instead of one lookup per host
+        if not self._load_netbox_index():
+            return {'status': 'failed', 'reason': 'netbox_index_failed'}
+        self._load_state()
+        
         report = self.generate_network_report()
         
         # Process each network
         for network in self.discovery_networks:
-            network = network.strip()
-            logger.info(f"🌐 Processing network: {network}")
+            logger.info("🌐 Processing network: %s", network)
             
             # Ensure prefix exists in NetBox
-            prefix = self.get_or_create_prefix(network, site['id'])
-            
-            # Discover hosts
-            discovered_hosts = self.perform_network_scan(network)
+            prefix = self.get_or_create_prefix(str(network), site['id'])
+        
+        scan_failed = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Discover hosts (nmap parallelizes the sweep itself). Each host is
+            # handed to the pool as soon as nmap reports it, so per-host
+            # DNS/HTTP work overlaps the rest of the sweep
+            discovered_hosts = self.perform_network_scan(self.discovery_networks)
             
-            for host in discovered_hosts:
-                report['total_hosts'] += 1
-                
-                # Perform detailed service scan for interesting hosts
-                if any(port in str(host['ip']) for port in ['1', '3', '10']):  # Gateway/server IPs
-                    host['services'] = self.perform_service_scan(host['ip'])
-                    report['services_discovered'] += len(host['services'])
-                
-                # Update NetBox
-                if self.update_netbox_ip(host):
-                    report['updated_hosts'] += 1
-                
-                # Sync to DNS if hostname available
-                if self.sync_to_dns(host):
-                    report['dns_synced'] += 1
-                
-                report['active_hosts'] += 1
+            try:
+                # Aggregate per-host results here rather than in the workers
+                for result in executor.map(self._process_host, discovered_hosts):
+                    report['total_hosts'] += 1
+                    report['services_discovered'] += result['services']
+                    if result['new']:
+                        report['new_hosts'] += 1
+                    if result['skipped']:
+                        report['skipped_hosts'] += 1
+                    if result['updated']:
+                        report['updated_hosts'] += 1
+                    if result['dns_synced']:
+                        report['dns_synced'] += 1
+                    report['active_hosts'] += 1
+            except NetworkScanError:
+                scan_failed = True
+        
+        # Write queued NetBox changes in bulk, then persist host state; hosts
+        # reported before a failed sweep aborted are still real
+        failed_ips = self._flush_netbox_ips()
+        report['updated_hosts'] -= len(failed_ips)
+        self._save_state(failed_ips)
+        
+        if scan_failed:
+            # Not 'completed', so the idle backoff doesn't count an outage as a quiet network
+            return {'status': 'failed', 'reason': 'network_scan_failed'}
         
         # Calculate duration
         duration = datetime.now() - start_time
         report['duration_seconds'] = duration.total_seconds()
         report['status'] = 'completed'
         
-        logger.info(f"✅ Discovery completed in {duration.total_seconds():.1f}s")
-        logger.info(f"📊 Stats: {report['active_hosts']} active hosts, {report['dns_synced']} DNS synced")
+        logger.info("✅ Discovery completed in %.1fs", duration.total_seconds())
+        logger.info("📊 Stats: %s active hosts, %s DNS synced", report['active_hosts'], report['dns_synced'])
         
         return report
 
@@ -389,13 +893,13 @@ class NetBoxDiscoveryAgent:
             os.makedirs('/app/exports', exist_ok=True)
             filepath = f"/app/exports/{filename}"
             
-            with open(filepath, 'w') as f:
-                json.dump(data, f, indent=2, default=str)
+            with open(filepath, 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2, default=str))
             
-            logger.info(f"✅ Data exported to {filepath}")
+            logger.info("✅ Data exported to %s", filepath)
             return True
         except Exception as e:
-            logger.error(f"❌ Export failed: {e}")
+            logger.error("❌ Export failed: %s", e)
             return False
 
 def main():
@@ -406,31 +910,42 @@ def main():
     
     agent = NetBoxDiscoveryAgent()
     
+    # Schedule regular discovery runs; run_discovery adapts the interval
+    agent.schedule_discovery(DISCOVERY_INTERVAL)
+    
     # Run initial discovery
     logger.info("🎯 Running initial network discovery")
     report = agent.run_discovery()
     agent.export_to_file(report, f"discovery-report-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
     
-    # Schedule regular discovery runs
-    schedule.every(30).minutes.do(agent.run_discovery)
+    # Export the latest report rather than triggering another scan
+    schedule.every().sunday.do(agent.reload_oui)
     schedule.every(1).hour.do(lambda: agent.export_to_file(
-        agent.run_discovery(),
+        agent.last_report,
         f"discovery-report-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
     ))
     
-    logger.info("⏰ Scheduled discovery: every 30 minutes")
+    logger.info("⏰ Scheduled discovery: every %s minutes, backing off to %s when idle",
+                DISCOVERY_INTERVAL, IDLE_DISCOVERY_INTERVAL)
     logger.info("📁 Data exports: every hour")
     
-    # Keep running
+    # Keep running, sleeping until the next job is due (capped so a clock
+    # change or reschedule is picked up within a few minutes)
     try:
         while True:
+            idle = schedule.idle_seconds()
+            if idle is None:
+                break
+            if idle > 0:
+                time.sleep(min(idle, 300))
             schedule.run_pending()
-            time.sleep(60)
     except KeyboardInterrupt:
         logger.info("🛑 Discovery agent stopped by user")
     except Exception as e:
-        logger.error(f"❌ Discovery agent crashed: {e}")
+        logger.error("❌ Discovery agent crashed: %s", e)
         raise
+    finally:
+        agent.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
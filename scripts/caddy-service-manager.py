@@ -5,17 +5,31 @@ Automatically manages Caddy configurations for discovered services
 Integrates with NetBox and Technitium DNS for complete automation
 """
 
+import io
 import os
+import ipaddress
+import re
 import json
+import time
+import functools
+import hashlib
 import logging
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yaml
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple, Iterable, Iterator, Callable, Union
 from datetime import datetime
 import subprocess
-import tempfile
 import shutil
+from collections import OrderedDict
+
+try:
+    import ahocorasick
+except ImportError:  # optional; only used for large pattern tables
+    ahocorasick = None
 
 # Configure logging
 logging.basicConfig(
@@ -24,19 +38,151 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=None)
+def _jinja_environment():
+    """Jinja environment for templates that need it; jinja2 is only imported here"""
+    import jinja2
+    
+    # Caddy's own {placeholders} pass through untouched since Jinja only
+    # reacts to {{ }}, {% %} and {# #}
+    return jinja2.Environment(autoescape=False, trim_blocks=True, lstrip_blocks=True)
+
+# A bare {{ name }} substitution; templates made only of these skip Jinja
+_PLACEHOLDER_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+def _compile_renderer(source: str) -> Callable[..., str]:
+    """Compile a template into a render(**fields) callable
+    
+    Plain substitution templates are split once into literals and field
+    names and rendered with a single join, which is several times faster
+    than a Jinja render; anything using Jinja blocks or filters goes
+    through Jinja, so jinja2 is only required when such a template exists.
+    """
+    parts = _PLACEHOLDER_RE.split(source)
+    literals, fields = parts[0::2], parts[1::2]
+    if any(marker in literal for literal in literals for marker in ('{{', '{%', '{#')):
+        return _jinja_environment().from_string(source).render
+    
+    head, tail = literals[0], list(zip(fields, literals[1:]))
+    
+    def render(**values) -> str:
+        out = [head]
+        for field, literal in tail:
+            out.append(str(values[field]))
+            out.append(literal)
+        return ''.join(out)
+    
+    return render
+
+# Service name patterns
+SERVICE_PATTERNS = {
+    'gitlab': {'port': 80, 'type': 'web', 'protocol': 'http'},
+    'git': {'port': 80, 'type': 'web', 'protocol': 'http'},
+    'netbox': {'port': 8080, 'type': 'web', 'protocol': 'http'},
+    'ipam': {'port': 8080, 'type': 'web', 'protocol': 'http'},
+    'grafana': {'port': 3000, 'type': 'monitoring', 'protocol': 'http'},
+    'prometheus': {'port': 9090, 'type': 'monitoring', 'protocol': 'http'},
+    'api': {'port': 8080, 'type': 'api', 'protocol': 'http'},
+    'docs': {'port': 8000, 'type': 'docs', 'protocol': 'http'},
+    'admin': {'port': 8080, 'type': 'secure', 'protocol': 'http'}
+}
+
+# Patterns only count as whole words: a letter on either side ("digital",
+# "mygitlabfoo") is not a hit, while digits and separators ("grafana01",
+# "git-runner") are
+_PATTERN_PRIORITY = {pattern: priority for priority, pattern in enumerate(SERVICE_PATTERNS)}
+_PATTERN_RE = re.compile(
+    r'(?<![a-z])(' + '|'.join(map(re.escape, SERVICE_PATTERNS)) + r')(?![a-z])'
+)
+
+# Above this many patterns the alternation regex stops being cheap, so
+# match with an Aho-Corasick automaton (one pass over the hostname) instead
+AUTOMATON_MIN_PATTERNS = 16
+
+def _build_pattern_automaton():
+    """Build an automaton over SERVICE_PATTERNS, or None for small tables"""
+    if ahocorasick is None or len(SERVICE_PATTERNS) <= AUTOMATON_MIN_PATTERNS:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for pattern in SERVICE_PATTERNS:
+        automaton.add_word(pattern, pattern)
+    automaton.make_automaton()
+    return automaton
+
+_PATTERN_AUTOMATON = _build_pattern_automaton()
+
+def _is_word(hostname_lower: str, start: int, end: int) -> bool:
+    """Check the same letter boundaries as _PATTERN_RE around hostname_lower[start:end]"""
+    before = hostname_lower[start - 1] if start > 0 else ''
+    after = hostname_lower[end] if end < len(hostname_lower) else ''
+    return not ('a' <= before <= 'z') and not ('a' <= after <= 'z')
+
+def _match_pattern(hostname_lower: str) -> Optional[str]:
+    """Return the first SERVICE_PATTERNS key (in table order) found in the hostname"""
+    if _PATTERN_AUTOMATON is not None:
+        matches = [
+            pattern for end, pattern in _PATTERN_AUTOMATON.iter(hostname_lower)
+            if _is_word(hostname_lower, end + 1 - len(pattern), end + 1)
+        ]
+    else:
+        matches = [m.group(1) for m in _PATTERN_RE.finditer(hostname_lower)]
+    
+    # Matches arrive in text order; table order decides between them
+    return min(matches, key=_PATTERN_PRIORITY.__getitem__) if matches else None
+
+@functools.lru_cache(maxsize=4096)
+def _detect_by_hostname(hostname_lower: str) -> Tuple[Dict, ...]:
+    """Match a lowercased hostname against SERVICE_PATTERNS (cached per hostname)"""
+    # Admin hostnames always get the hardened template, whatever they run
+    secure = 'admin' in hostname_lower
+    
+    pattern = _match_pattern(hostname_lower)
+    if pattern is not None:
+        config = SERVICE_PATTERNS[pattern]
+        return ({
+            'type': config['type'],
+            'port': config['port'],
+            'protocol': config['protocol'],
+            'template_key': 'secure' if secure else config['type']
+        },)
+    
+    # If no pattern matched, default to web service
+    return ({
+        'type': 'web',
+        'port': 80,
+        'protocol': 'http',
+        'template_key': 'secure' if secure else 'web'
+    },)
+
+# Number of Caddyfile backups kept in the backup directory
+BACKUP_KEEP = 20
+
+# Number of adapted (Caddyfile -> JSON) configs remembered per run
+ADAPT_CACHE_SIZE = 8
+
+def _atomic_write(path: Path, data: str):
+    """Write a file via a sibling temp file so readers never see a partial write"""
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    tmp.write_text(data)
+    os.replace(tmp, path)
+
 class CaddyServiceManager:
     def __init__(self):
         self.netbox_url = os.getenv('NETBOX_URL', 'http://localhost:8080')
         self.netbox_token = os.getenv('NETBOX_API_TOKEN')
         self.gitlab_server = os.getenv('GITLAB_SERVER', 'git.doofus.co')
         self.domain = os.getenv('BASE_DOMAIN', 'doofus.co')
+        self._domain_suffix = f'.{self.domain}'
         self.cloudflare_token = os.getenv('CLOUDFLARE_API_TOKEN')
+        self.caddy_admin_url = os.getenv('CADDY_ADMIN_URL', 'http://localhost:2019').rstrip('/')
         
         # Caddy configuration paths
         self.caddy_config_dir = Path('/opt/caddy')
         self.services_config_dir = self.caddy_config_dir / 'services'
         self.main_caddyfile = self.caddy_config_dir / 'Caddyfile'
         self.backup_dir = self.caddy_config_dir / 'backups'
+        self.config_hash_file = self.caddy_config_dir / '.Caddyfile.hash'
         
         # Service discovery rules
         self.service_rules = {
@@ -52,62 +198,67 @@ class CaddyServiceManager:
         # Service templates
         self.service_templates = {
             'web': '''
-{hostname} {{
-    tls {{
-        dns cloudflare {{env.CLOUDFLARE_API_TOKEN}}
-    }}
-    reverse_proxy {ip}:{port} {{
-        header_up Host {{upstream_hostport}}
-        header_up X-Real-IP {{remote_host}}
-        header_up X-Forwarded-For {{remote_host}}
-        header_up X-Forwarded-Proto {{scheme}}
-    }}
+{{ hostname }} {
+    tls {
+        dns cloudflare {env.CLOUDFLARE_API_TOKEN}
+    }
+    reverse_proxy {{ ip }}:{{ port }} {
+        header_up Host {upstream_hostport}
+        header_up X-Real-IP {remote_host}
+        header_up X-Forwarded-For {remote_host}
+        header_up X-Forwarded-Proto {scheme}
+    }
     encode gzip
-    log {{
-        output file /var/log/caddy/{service}-access.log
+    log {
+        output file /var/log/caddy/{{ service }}-access.log
         format json
-    }}
-}}''',
+    }
+}''',
             'api': '''
-{hostname} {{
-    tls {{
-        dns cloudflare {{env.CLOUDFLARE_API_TOKEN}}
-    }}
-    reverse_proxy {ip}:{port} {{
-        header_up Host {{upstream_hostport}}
-        header_up X-Real-IP {{remote_host}}
-        header_up X-Forwarded-For {{remote_host}}
-        header_up X-Forwarded-Proto {{scheme}}
-    }}
+{{ hostname }} {
+    tls {
+        dns cloudflare {env.CLOUDFLARE_API_TOKEN}
+    }
+    reverse_proxy {{ ip }}:{{ port }} {
+        header_up Host {upstream_hostport}
+        header_up X-Real-IP {remote_host}
+        header_up X-Forwarded-For {remote_host}
+        header_up X-Forwarded-Proto {scheme}
+    }
     # API-specific headers
-    header {{
+    header {
         Access-Control-Allow-Origin *
         Access-Control-Allow-Methods "GET, POST, PUT, DELETE, OPTIONS"
         Access-Control-Allow-Headers "Content-Type, Authorization"
-    }}
+    }
     encode gzip
-}}''',
+}''',
             'secure': '''
-{hostname} {{
-    tls {{
-        dns cloudflare {{env.CLOUDFLARE_API_TOKEN}}
-    }}
-    reverse_proxy {ip}:{port} {{
-        header_up Host {{upstream_hostport}}
-        header_up X-Real-IP {{remote_host}}
-        header_up X-Forwarded-For {{remote_host}}
-        header_up X-Forwarded-Proto {{scheme}}
-    }}
+{{ hostname }} {
+    tls {
+        dns cloudflare {env.CLOUDFLARE_API_TOKEN}
+    }
+    reverse_proxy {{ ip }}:{{ port }} {
+        header_up Host {upstream_hostport}
+        header_up X-Real-IP {remote_host}
+        header_up X-Forwarded-For {remote_host}
+        header_up X-Forwarded-Proto {scheme}
+    }
     # Security headers
-    header {{
+    header {
         Strict-Transport-Security "max-age=31536000; includeSubDomains; preload"
         X-Frame-Options DENY
         X-Content-Type-Options nosniff
         X-XSS-Protection "1; mode=block"
         Content-Security-Policy "default-src 'self'"
-    }}
+    }
     encode gzip
-}}'''
+}'''
+        }
+        
+        # Compile templates once rather than re-parsing them per service
+        self.compiled_templates = {
+            key: _compile_renderer(template) for key, template in self.service_templates.items()
         }
         
         # NetBox headers
@@ -117,29 +268,46 @@ class CaddyServiceManager:
             'Accept': 'application/json'
         }
         
+        # Pooled NetBox session so pagination reuses one keep-alive connection
+        self.session = requests.Session()
+        self.session.headers.update(self.netbox_headers)
+        adapter = HTTPAdapter(
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # Separate session for the Caddy admin API so NetBox credentials never reach it
+        self.caddy_session = requests.Session()
+        self.caddy_session.headers.update({'Content-Type': 'text/caddyfile'})
+        
+        # Adapted JSON keyed by the Caddyfile's sha256, so validate + reload adapt once
+        self._adapt_cache: 'OrderedDict[bytes, bytes]' = OrderedDict()
+        
         # Ensure directories exist
         self.services_config_dir.mkdir(parents=True, exist_ok=True)
         self.backup_dir.mkdir(parents=True, exist_ok=True)
 
-    def get_services_from_netbox(self) -> List[Dict]:
-        """Retrieve services from NetBox with port information"""
-        services = []
-        try:
-            # Get all IP addresses with associated services
-            response = requests.get(
-                f"{self.netbox_url}/api/ipam/ip-addresses/",
-                headers=self.netbox_headers,
-                params={'limit': 1000, 'status': 'active'}
-            )
+    def iter_services_from_netbox(self) -> Iterator[Dict]:
+        """Yield services from NetBox page by page; raises if NetBox cannot be read"""
+        # Get all IP addresses with associated services, following pagination
+        url = f"{self.netbox_url}/api/ipam/ip-addresses/"
+        params = {'limit': 1000, 'status': 'active'}
+        
+        while url:
+            response = self.session.get(url, params=params)
             
             if response.status_code != 200:
-                logger.error(f"Failed to get IPs from NetBox: {response.status_code}")
-                return services
+                raise RuntimeError(f"Failed to get IPs from NetBox: {response.status_code}")
+            
+            # orjson decodes large result pages faster than response.json()
+            page = orjson.loads(response.content)
             
-            for ip_data in response.json()['results']:
+            for ip_data in page['results']:
                 if not ip_data.get('dns_name'):
                     continue
-                    
+                
                 # Extract hostname for service detection
                 hostname = ip_data['dns_name']
                 ip_address = ip_data['address'].split('/')[0]  # Remove CIDR
@@ -151,15 +319,23 @@ class CaddyServiceManager:
                 detected_services = self.detect_services(hostname, ip_address, custom_fields)
                 
                 for service in detected_services:
-                    services.append({
+                    yield {
                         'hostname': hostname,
                         'ip': ip_address,
                         'service_type': service['type'],
                         'port': service['port'],
                         'protocol': service['protocol'],
+                        'template_key': service['template_key'],
                         'custom_config': service.get('custom_config', {})
-                    })
+                    }
             
+            # The next link already carries the query string
+            url, params = page.get('next'), None
+
+    def get_services_from_netbox(self) -> List[Dict]:
+        """Retrieve services from NetBox with port information"""
+        try:
+            services = list(self.iter_services_from_netbox())
             logger.info(f"Retrieved {len(services)} services from NetBox")
             return services
             
@@ -169,78 +345,78 @@ class CaddyServiceManager:
 
     def detect_services(self, hostname: str, ip: str, custom_fields: Dict) -> List[Dict]:
         """Detect services based on hostname patterns and custom data"""
-        detected = []
-        
-        # Service name patterns
-        service_patterns = {
-            'gitlab': {'port': 80, 'type': 'web', 'protocol': 'http'},
-            'git': {'port': 80, 'type': 'web', 'protocol': 'http'},
-            'netbox': {'port': 8080, 'type': 'web', 'protocol': 'http'},
-            'ipam': {'port': 8080, 'type': 'web', 'protocol': 'http'},
-            'grafana': {'port': 3000, 'type': 'monitoring', 'protocol': 'http'},
-            'prometheus': {'port': 9090, 'type': 'monitoring', 'protocol': 'http'},
-            'api': {'port': 8080, 'type': 'api', 'protocol': 'http'},
-            'docs': {'port': 8000, 'type': 'docs', 'protocol': 'http'},
-            'admin': {'port': 8080, 'type': 'secure', 'protocol': 'http'}
-        }
-        
-        hostname_lower = hostname.lower()
-        
-        # Check hostname patterns
-        for pattern, config in service_patterns.items():
-            if pattern in hostname_lower:
-                detected.append({
-                    'type': config['type'],
-                    'port': config['port'],
-                    'protocol': config['protocol']
-                })
-                break
-        
-        # If no pattern matched, default to web service
-        if not detected:
-            detected.append({
-                'type': 'web',
-                'port': 80,
-                'protocol': 'http'
-            })
-        
-        return detected
+        return [dict(service) for service in _detect_by_hostname(hostname.lower())]
+
+    def _template_key(self, service: Dict) -> str:
+        """Pick the template used for a service"""
+        # Detected services carry their template; only hand-built ones need the check
+        template_key = service.get('template_key')
+        if template_key is None:
+            template_key = 'secure' if 'admin' in service['hostname'].lower() else service['service_type']
+        return template_key
+
+    def _site_address(self, service: Dict) -> str:
+        """Site address a service renders as (bare names get the base domain)"""
+        hostname = service['hostname']
+        if not hostname.endswith(self._domain_suffix):
+            if '.' not in hostname:
+                hostname = f"{hostname}{self._domain_suffix}"
+        return hostname
+
+    @staticmethod
+    def _upstream_key(service: Dict) -> Tuple:
+        """Sort key for picking one upstream among services for the same site"""
+        try:
+            address = ipaddress.ip_address(service['ip'])
+            return (0, address.version, int(address), service['port'])
+        except ValueError:
+            return (1, service['ip'], service['port'])
 
     def generate_service_config(self, service: Dict) -> str:
         """Generate Caddy configuration for a service"""
-        service_type = service['service_type']
-        template_key = 'secure' if 'admin' in service['hostname'] else service_type
-        template = self.service_templates.get(template_key, self.service_templates['web'])
+        template_key = self._template_key(service)
+        template = self.compiled_templates.get(template_key, self.compiled_templates['web'])
         
         # Prepare hostname (ensure it has domain)
-        hostname = service['hostname']
-        if not hostname.endswith(f'.{self.domain}'):
-            if '.' not in hostname:
-                hostname = f"{hostname}.{self.domain}"
+        hostname = self._site_address(service)
         
-        config = template.format(
+        config = template(
             hostname=hostname,
             ip=service['ip'],
             port=service['port'],
-            service=service['hostname'].split('.')[0]  # Service name for logging
+            service=service['hostname'].partition('.')[0]  # Service name for logging
         )
         
         return config
 
     def backup_current_config(self) -> str:
         """Create backup of current Caddy configuration"""
-        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-        backup_file = self.backup_dir / f"Caddyfile.backup.{timestamp}"
+        # Nanosecond names cannot collide when updates land within the same second
+        backup_file = self.backup_dir / f"Caddyfile.backup.{time.time_ns()}"
         
         if self.main_caddyfile.exists():
-            shutil.copy2(self.main_caddyfile, backup_file)
+            # copy (not copy2) so the backup's mtime records when it was taken
+            shutil.copy(self.main_caddyfile, backup_file)
             logger.info(f"Backed up Caddyfile to {backup_file}")
+            self.prune_backups()
             return str(backup_file)
         
         return ""
 
-    def generate_main_caddyfile(self, services: List[Dict]) -> str:
-        """Generate the main Caddyfile with all services"""
+    def prune_backups(self, keep: int = BACKUP_KEEP):
+        """Delete all but the newest `keep` Caddyfile backups"""
+        backups = sorted(self.backup_dir.glob('Caddyfile.backup.*'), key=lambda p: (p.stat().st_mtime_ns, p.name))
+        for old in backups[:-keep]:
+            old.unlink()
+
+    def generate_main_caddyfile(self, services: Iterable[Dict], summary: Optional[List[Tuple]] = None) -> str:
+        """Generate the main Caddyfile with all services
+        
+        services may be a lazy iterator, consumed page by page as NetBox returns it.
+        Caddy rejects two blocks for the same site address, so each address
+        is rendered once, using the lowest (ip, port) upstream seen for it.
+        When summary is given, each rendered (hostname, ip, port) is appended.
+        """
         header = f'''# Auto-generated Caddyfile - {datetime.now().isoformat()}
 # Generated by Caddy Service Manager
 # DO NOT EDIT MANUALLY - Changes will be overwritten
@@ -253,42 +429,123 @@ class CaddyServiceManager:
 
 '''
         
-        service_configs = []
+        # Stream fragments into one buffer rather than collecting and joining them
+        buf = io.StringIO()
+        buf.write(header)
         
-        # Generate configuration for each service
+        chosen = []
+        sites = {}
         for service in services:
-            config = self.generate_service_config(service)
-            service_configs.append(config)
+            # The same site twice would fail validation and abort the update
+            address = self._site_address(service).lower()
+            index = sites.get(address)
+            if index is None:
+                sites[address] = len(chosen)
+                chosen.append(service)
+                continue
+            
+            # Keep the lowest upstream so the choice doesn't depend on NetBox order
+            kept, dropped = chosen[index], service
+            if self._upstream_key(service) == self._upstream_key(kept):
+                continue
+            if self._upstream_key(service) < self._upstream_key(kept):
+                kept, dropped = service, kept
+                chosen[index] = service
+            logger.warning(
+                f"Duplicate site {address}: using {kept['ip']}:{kept['port']}, "
+                f"dropping {dropped['ip']}:{dropped['port']}"
+            )
         
-        # Combine all configurations
-        full_config = header + '\n'.join(service_configs)
+        # Rendering is a ~1us join per service, so it runs inline; a thread
+        # pool's submit/result overhead costs more than the render itself
+        for service in chosen:
+            buf.write(self.generate_service_config(service))
+            buf.write('\n')
         
-        return full_config
+        if summary is not None:
+            summary.extend((service['hostname'], service['ip'], service['port']) for service in chosen)
+        
+        return buf.getvalue()
+
+    def _config_digest(self, config_content: str) -> str:
+        """Hash a generated Caddyfile, ignoring its timestamp line"""
+        _, _, body = config_content.partition('\n')
+        return hashlib.sha256(body.encode()).hexdigest()
 
-    def validate_caddy_config(self, config_content: str) -> bool:
-        """Validate Caddy configuration syntax"""
+    def _current_config_digest(self) -> Optional[str]:
+        """Digest of the deployed Caddyfile, from the sidecar hash file when present"""
+        if not self.main_caddyfile.exists():
+            return None
+        if self.config_hash_file.exists():
+            return self.config_hash_file.read_text().strip()
+        return self._config_digest(self.main_caddyfile.read_text())
+
+    def _cache_adapted(self, key: bytes, adapted: bytes):
+        """Remember an adapted config, evicting the least recently used one"""
+        self._adapt_cache[key] = adapted
+        self._adapt_cache.move_to_end(key)
+        while len(self._adapt_cache) > ADAPT_CACHE_SIZE:
+            self._adapt_cache.popitem(last=False)
+
+    def validate_caddy_config(self, config_content: Union[str, bytes], provision: bool = False) -> bool:
+        """Validate Caddy configuration
+        
+        By default this only checks that the running Caddy can parse (adapt)
+        the config; module and TLS problems surface when it is loaded. With
+        provision=True, `caddy validate` is used, which also provisions modules.
+        """
+        data = config_content.encode() if isinstance(config_content, str) else config_content
+        
+        if provision:
+            if shutil.which('caddy'):
+                return self._validate_with_cli(data)
+            logger.warning("caddy binary not found, only checking that the config parses")
+        
+        key = hashlib.sha256(data).digest()
+        if key in self._adapt_cache:
+            self._adapt_cache.move_to_end(key)
+            logger.info("✅ Caddy configuration parsed")
+            return True
+        
         try:
-            # Write config to temporary file
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.caddyfile', delete=False) as temp_file:
-                temp_file.write(config_content)
-                temp_file_path = temp_file.name
+            # Ask the running Caddy to adapt the Caddyfile; a 200 means it parsed
+            response = self.caddy_session.post(
+                f"{self.caddy_admin_url}/adapt",
+                data=data,
+                timeout=30
+            )
             
-            # Validate using Caddy
+            if response.status_code == 200:
+                self._cache_adapted(key, orjson.dumps(orjson.loads(response.content)['result']))
+                logger.info("✅ Caddy configuration parsed")
+                return True
+            else:
+                logger.error(f"❌ Caddy configuration validation failed: {response.text}")
+                return False
+        
+        except requests.ConnectionError:
+            logger.warning("Caddy admin API unreachable, validating with caddy CLI")
+            return self._validate_with_cli(data)
+        except Exception as e:
+            logger.error(f"Error validating Caddy config: {e}")
+            return False
+
+    def _validate_with_cli(self, data: bytes) -> bool:
+        """Validate Caddy configuration with the caddy binary"""
+        try:
+            # Pipe the config in on stdin rather than round-tripping through a temp file
             result = subprocess.run(
-                ['caddy', 'validate', '--config', temp_file_path],
+                ['caddy', 'validate', '--adapter', 'caddyfile', '--config', '/dev/stdin'],
+                input=data,
                 capture_output=True,
-                text=True,
                 timeout=30
             )
             
-            # Clean up temp file
-            os.unlink(temp_file_path)
-            
             if result.returncode == 0:
                 logger.info("✅ Caddy configuration is valid")
                 return True
             else:
-                logger.error(f"❌ Caddy configuration validation failed: {result.stderr}")
+                logger.error(f"❌ Caddy configuration validation failed: {result.stderr.decode(errors='replace')}")
                 return False
                 
         except Exception as e:
@@ -298,7 +555,41 @@ class CaddyServiceManager:
     def reload_caddy(self) -> bool:
         """Reload Caddy with new configuration"""
         try:
-            # Use Caddy API to reload configuration
+            data = self.main_caddyfile.read_bytes()
+            
+            # Load through the admin API; Caddy swaps configs in-process. Send the
+            # already-adapted JSON when validation produced it, so Caddy skips
+            # parsing the Caddyfile a second time
+            adapted = self._adapt_cache.get(hashlib.sha256(data).digest())
+            if adapted is not None:
+                data, headers = adapted, {'Content-Type': 'application/json'}
+            else:
+                headers = None
+            
+            response = self.caddy_session.post(
+                f"{self.caddy_admin_url}/load",
+                data=data,
+                headers=headers,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                logger.info("✅ Caddy reloaded successfully")
+                return True
+            else:
+                logger.error(f"❌ Caddy reload failed: {response.text}")
+                return False
+        
+        except requests.ConnectionError:
+            logger.warning("Caddy admin API unreachable, reloading with caddy CLI")
+            return self._reload_with_cli()
+        except Exception as e:
+            logger.error(f"Error reloading Caddy: {e}")
+            return False
+
+    def _reload_with_cli(self) -> bool:
+        """Reload Caddy with the caddy binary"""
+        try:
             result = subprocess.run(
                 ['caddy', 'reload', '--config', str(self.main_caddyfile)],
                 capture_output=True,
@@ -321,15 +612,25 @@ class CaddyServiceManager:
         """Main method to update Caddy configuration from NetBox"""
         logger.info("🔄 Starting Caddy configuration update")
         
-        # Get services from NetBox
-        services = self.get_services_from_netbox()
+        # Generate new configuration, streaming services straight from NetBox
+        services = []
+        try:
+            new_config = self.generate_main_caddyfile(self.iter_services_from_netbox(), services)
+        except Exception as e:
+            logger.error(f"Error getting services from NetBox: {e}")
+            return False
         
         if not services:
             logger.warning("No services found in NetBox")
             return False
         
-        # Generate new configuration
-        new_config = self.generate_main_caddyfile(services)
+        logger.info(f"Retrieved {len(services)} services from NetBox")
+        new_digest = self._config_digest(new_config)
+        
+        # Nothing to do if the deployed configuration is already identical
+        if new_digest == self._current_config_digest():
+            logger.info("✅ Caddy configuration unchanged, skipping reload")
+            return True
         
         # Validate configuration
         if not self.validate_caddy_config(new_config):
@@ -340,18 +641,21 @@ class CaddyServiceManager:
         backup_file = self.backup_current_config()
         
         try:
-            # Write new configuration
-            self.main_caddyfile.write_text(new_config)
+            # Write new configuration; an empty hash marks it as not yet
+            # deployed so a failed reload is retried on the next run
+            self.config_hash_file.write_text('')
+            _atomic_write(self.main_caddyfile, new_config)
             logger.info(f"✅ Updated Caddyfile with {len(services)} services")
             
             # Reload Caddy
             if self.reload_caddy():
+                self.config_hash_file.write_text(new_digest)
                 logger.info("🎉 Caddy configuration updated successfully")
                 
                 # Log service summary
                 logger.info("📋 Configured services:")
-                for service in services:
-                    logger.info(f"   • {service['hostname']} -> {service['ip']}:{service['port']}")
+                for hostname, ip, port in services:
+                    logger.info(f"   • {hostname} -> {ip}:{port}")
                 
                 return True
             else:
@@ -370,7 +674,15 @@ class CaddyServiceManager:
             return False
 
     def add_service_manually(self, hostname: str, ip: str, port: int, service_type: str = 'web') -> bool:
-        """Manually add a service to Caddy configuration"""
+        """Manually add a service to Caddy configuration
+        
+        Sites without access logging (the api and secure templates) are spliced
+        into the running Caddy through the admin API. That route lives only in
+        the running config: the generated Caddyfile is built from NetBox alone,
+        so the next full reload drops it unless the host is in NetBox. The
+        default web template has a log directive and always takes the full
+        update path instead.
+        """
         logger.info(f"➕ Adding service manually: {hostname} -> {ip}:{port}")
         
         # Create service object
@@ -387,11 +699,155 @@ class CaddyServiceManager:
         
         # Write to individual service file
         service_file = self.services_config_dir / f"{hostname.replace('.', '_')}.caddyfile"
-        service_file.write_text(service_config)
+        _atomic_write(service_file, service_config)
+        
+        # Fast path: splice just this site into the running Caddy
+        if self._add_site_via_admin(service_config):
+            # The running config no longer matches the Caddyfile on disk, so the
+            # next --update must reload rather than skip as unchanged
+            self.config_hash_file.write_text('')
+            logger.info(f"🎉 Added {hostname} to running Caddy configuration")
+            logger.warning(
+                f"⚠️ {hostname} is only in the running config and will be dropped on the "
+                f"next full reload unless it is added to NetBox"
+            )
+            return True
         
         # Update main configuration
         return self.update_caddy_configuration()
 
+    @staticmethod
+    def _route_hosts(route: Dict) -> set:
+        """Hostnames a Caddy JSON route matches on"""
+        return {host for matcher in route.get('match', []) for host in matcher.get('host', [])}
+
+    def _add_site_via_admin(self, service_config: str) -> bool:
+        """Add or replace one rendered site in the running config through the admin API
+        
+        Returns False, leaving the running config as it was, whenever the site
+        can't be spliced in exactly as a full reload would produce it.
+        """
+        json_headers = {'Content-Type': 'application/json'}
+        policies_url = f"{self.caddy_admin_url}/config/apps/tls/automation/policies"
+        try:
+            # Adapting the fragment on its own also validates it
+            response = self.caddy_session.post(
+                f"{self.caddy_admin_url}/adapt",
+                data=service_config.encode(),
+                timeout=30
+            )
+            if response.status_code != 200:
+                logger.error(f"❌ Caddy configuration parsing failed: {response.text}")
+                return False
+            
+            adapted = orjson.loads(response.content)['result']
+            adapted_servers = adapted['apps']['http']['servers'].values()
+            
+            # Access logs need top-level logging plus per-server logger maps;
+            # leave sites with a log directive to a full reload
+            if 'logging' in adapted or any('logs' in server for server in adapted_servers):
+                logger.info("Site uses access logging, falling back to full update")
+                return False
+            
+            routes = [route for server in adapted_servers for route in server.get('routes', [])]
+            hosts = set().union(*map(self._route_hosts, routes))
+            policies = adapted['apps'].get('tls', {}).get('automation', {}).get('policies', [])
+            
+            # Find the HTTPS server in the running config to attach the routes to
+            response = self.caddy_session.get(f"{self.caddy_admin_url}/config/apps/http/servers", timeout=30)
+            servers = orjson.loads(response.content) if response.status_code == 200 else None
+            server_name = next(
+                (name for name, server in (servers or {}).items() if ':443' in server.get('listen', [])),
+                None
+            )
+            if server_name is None:
+                logger.warning("No HTTPS server in running Caddy config, falling back to full update")
+                return False
+            
+            # A re-added host replaces its old route rather than queueing behind it
+            running_routes = servers[server_name].get('routes') or []
+            existing = [i for i, route in enumerate(running_routes) if self._route_hosts(route) & hosts]
+            if existing and (len(existing) > 1 or len(routes) != 1
+                             or not self._route_hosts(running_routes[existing[0]]) <= hosts):
+                logger.warning("Running routes for this site don't map one-to-one, falling back to full update")
+                return False
+            
+            response = self.caddy_session.get(policies_url, timeout=30)
+            running_policies = (orjson.loads(response.content) if response.status_code == 200 else None) or []
+            covered = {subject for policy in running_policies for subject in policy.get('subjects', [])}
+            new_policies = [policy for policy in policies if not set(policy.get('subjects', [])) <= covered]
+            
+            # Caddy uses the first matching policy, and the global email option
+            # leaves a catch-all (no subjects) at the end; new policies go before it
+            insert_at = next(
+                (i for i, policy in enumerate(running_policies) if not policy.get('subjects')),
+                len(running_policies)
+            )
+        
+        except requests.ConnectionError:
+            logger.warning("Caddy admin API unreachable, falling back to full update")
+            return False
+        except Exception as e:
+            logger.warning(f"Error adding site via admin API, falling back to full update: {e}")
+            return False
+        
+        # From here on the running config is modified; undo on any failure
+        added_policies = 0
+        try:
+            # PUT to an array index inserts there, shifting later policies down
+            for policy in new_policies:
+                response = self.caddy_session.put(
+                    f"{policies_url}/{insert_at + added_policies}",
+                    data=orjson.dumps(policy),
+                    headers=json_headers,
+                    timeout=30
+                )
+                if response.status_code != 200:
+                    logger.warning(f"Could not add TLS policy via admin API: {response.text}")
+                    self._remove_policies(policies_url, insert_at, added_policies)
+                    return False
+                added_policies += 1
+            
+            routes_url = f"{self.caddy_admin_url}/config/apps/http/servers/{server_name}/routes"
+            if existing:
+                response = self.caddy_session.patch(
+                    f"{routes_url}/{existing[0]}",
+                    data=orjson.dumps(routes[0]),
+                    headers=json_headers,
+                    timeout=30
+                )
+            else:
+                response = self.caddy_session.post(
+                    f"{routes_url}/...",
+                    data=orjson.dumps(routes),
+                    headers=json_headers,
+                    timeout=30
+                )
+            if response.status_code != 200:
+                logger.warning(f"Could not add route via admin API: {response.text}")
+                self._remove_policies(policies_url, insert_at, added_policies)
+                return False
+            
+            return True
+        
+        except Exception as e:
+            logger.warning(f"Error adding site via admin API, falling back to full update: {e}")
+            self._remove_policies(policies_url, insert_at, added_policies)
+            return False
+
+    def _remove_policies(self, policies_url: str, start: int, count: int):
+        """Roll back TLS policies inserted by a failed fast-path add"""
+        if not count:
+            return
+        try:
+            # Delete from the end so earlier indexes stay valid
+            for index in reversed(range(start, start + count)):
+                self.caddy_session.delete(f"{policies_url}/{index}", timeout=30).raise_for_status()
+        except Exception as e:
+            logger.error(f"Could not roll back TLS policies: {e}")
+            # Make the fallback full update reload from disk instead of skipping it
+            self.config_hash_file.write_text('')
+
 def main():
     """Main CLI entry point"""
     import argparse
@@ -399,8 +855,10 @@ def main():
     parser = argparse.ArgumentParser(description='Caddy Service Manager')
     parser.add_argument('--update', action='store_true', help='Update Caddy configuration from NetBox')
     parser.add_argument('--add', nargs=4, metavar=('HOSTNAME', 'IP', 'PORT', 'TYPE'), 
-                       help='Manually add service: hostname ip port type')
-    parser.add_argument('--validate', action='store_true', help='Validate current Caddy configuration')
+                       help='Manually add service: hostname ip port type (api/secure types go live via '
+                            'the admin API until the next full reload; web always runs a full update)')
+    parser.add_argument('--validate', action='store_true',
+                       help='Validate current Caddy configuration with caddy validate (provisions modules)')
     
     args = parser.parse_args()
     
@@ -417,8 +875,8 @@ def main():
     
     elif args.validate:
         if manager.main_caddyfile.exists():
-            config = manager.main_caddyfile.read_text()
-            valid = manager.validate_caddy_config(config)
+            config = manager.main_caddyfile.read_bytes()
+            valid = manager.validate_caddy_config(config, provision=True)
             print("✅ Configuration is valid" if valid else "❌ Configuration is invalid")
             exit(0 if valid else 1)
         else: